@@ -2,6 +2,7 @@ import os
 import numpy as np
 import torch
 import glob
+import warnings
 
 from .base_dataset import BaseDataset
 
@@ -15,36 +16,15 @@ class DOTADataset(BaseDataset):
             self.category[name.replace(" ", "-")] = i
 
     def load_files(self, label_path):
-        lines = open(label_path, 'r').readlines()
-
-        x1, y1, x2, y2, x3, y3, x4, y4, labels = [], [], [], [], [], [], [], [], []
-
-        for line in lines:
-            line = line.split(' ')
-            x1.append(float(line[0]))
-            y1.append(float(line[1]))
-            x2.append(float(line[2]))
-            y2.append(float(line[3]))
-            x3.append(float(line[4]))
-            y3.append(float(line[5]))
-            x4.append(float(line[6]))
-            y4.append(float(line[7]))
-            labels.append(self.category[line[8]])
-
-        if len(labels):
-            x1 = torch.tensor(x1)
-            y1 = torch.tensor(y1)
-            x2 = torch.tensor(x2)
-            y2 = torch.tensor(y2)
-            x3 = torch.tensor(x3)
-            y3 = torch.tensor(y3)
-            x4 = torch.tensor(x4)
-            y4 = torch.tensor(y4)
-            labels = torch.tensor(labels)
-
-            polys = torch.stack((x1, y1, x2, y2, x3, y3, x4, y4), -1).type(torch.float32)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')  # empty label files
+            lines = np.loadtxt(label_path, dtype=str, ndmin=2)
 
+        if len(lines):
+            polys = torch.from_numpy(lines[:, :8].astype(np.float32))
+            labels = torch.from_numpy(np.fromiter(map(self.category.__getitem__, lines[:, 8]), dtype=np.int64, count=len(lines)))
         else:
             polys = torch.zeros((0, 8), dtype=torch.float32)
+            labels = torch.zeros((0,), dtype=torch.int64)
 
-        return polys, labels
\ No newline at end of file
+        return polys, labels
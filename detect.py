@@ -56,9 +56,10 @@ class Detect:
 
             with torch.no_grad():
                 temp = time.time()
-                outputs, infer_outputs = self.model(img, training=False)
+                with torch.autocast(self.device.type, enabled=self.args.amp):
+                    outputs, infer_outputs = self.model(img, training=False)
                 temp1 = time.time()
-                boxes = post_process(infer_outputs, self.args.conf_thres, self.args.nms_thres)
+                boxes = post_process(infer_outputs.float(), self.args.conf_thres, self.args.nms_thres)
                 temp2 = time.time()
 
                 logger.info('-----------------------------------')
@@ -94,6 +95,7 @@ if __name__ == "__main__":
     parser.add_argument("--data", type=str, default="", help=".yaml path for data")
     parser.add_argument("--hyp", type=str, default="", help=".yaml path for hyperparameters")
     parser.add_argument("--ext", type=str, default="png", choices=["png", "jpg"], help="Image file format")
+    parser.add_argument("--amp", action="store_true", help="run inference in mixed precision")
     args = parser.parse_args()
     print(args)
 
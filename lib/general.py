@@ -1,6 +1,5 @@
 import torch
 import numpy as np
-import cv2 as cv
 from detectron2.layers.nms import nms_rotated
 
 
@@ -47,22 +46,17 @@ def xywha2xyxyxyxy(boxes):
     Returns:
         rboxes (torch.Tensor): shape(N, 4, 2)
     """
-    num_samples = boxes.size(0)
-    Rs = torch.zeros((num_samples, 2, 3))
     x, y, w, h, theta = boxes.unbind(dim=-1)
 
-    for i in range(num_samples):
-        R = cv.getRotationMatrix2D((float(x[i]), float(y[i])), float(theta[i] * 180 / np.pi), 1)
-        Rs[i] = torch.from_numpy(R)
+    # same rotation as cv.getRotationMatrix2D around the center of each box
+    cos, sin = torch.cos(theta)[:, None], torch.sin(theta)[:, None]
 
-    x1, y1 = x - h / 2, y - w / 2
-    x2, y2 = x + h / 2, y - w / 2
-    x3, y3 = x + h / 2, y + w / 2
-    x4, y4 = x - h / 2, y + w / 2
+    dx = torch.stack((-h, h, h, -h), dim=-1) / 2
+    dy = torch.stack((-w, -w, w, w), dim=-1) / 2
 
-    p = torch.stack((x1, y1, x2, y2, x3, y3, x4, y4), dim=-1).reshape(-1, 4, 2)
-    p = torch.cat((p, torch.ones((num_samples, 4, 1))), dim=-1)
-    rboxes = torch.bmm(p, Rs.permute((0, 2, 1)))
+    px = x[:, None] + cos * dx + sin * dy
+    py = y[:, None] - sin * dx + cos * dy
+    rboxes = torch.stack((px, py), dim=-1)
 
     return rboxes
 
@@ -78,7 +72,6 @@ def xyxyxyxy2xywha(boxes):
     Returns:
         boxes (torch.Tensor): shape(N, 5)
     """
-    num_samples = boxes.size(0)
     x1, y1, x2, y2, x3, y3, x4, y4 = boxes.unbind(dim=-1)
 
     x = (x1 + x2 + x3 + x4) / 4
@@ -90,13 +83,9 @@ def xyxyxyxy2xywha(boxes):
     theta = -(torch.atan2(y1 - y2, x1 - x2) + torch.atan2(y4 - y3, x4 - x3)) / 2
 
     # Make the height of bounding boxes always larger then it's width
-    for i in range(num_samples):
-        if w[i] >= h[i]:
-            w[i], h[i] = h[i].clone(), w[i].clone()
-            if theta[i] > 0:
-                theta[i] = theta[i] - np.pi / 2
-            else:
-                theta[i] = theta[i] + np.pi / 2
+    swap = w >= h
+    w, h = torch.where(swap, h, w), torch.where(swap, w, h)
+    theta = torch.where(swap, torch.where(theta > 0, theta - np.pi / 2, theta + np.pi / 2), theta)
 
     # ensure the range of theta span in [-np.pi / 2, np.pi / 2)
     theta = norm_angle(theta)
@@ -151,21 +140,19 @@ def post_process(predictions, conf_thres=0.5, iou_thres=0.4):
     outputs = [torch.zeros((0, 7), device=predictions.device)] * predictions.size(0)
 
     for batch, image_pred in enumerate(predictions):
-        # Object confidence times class confidence
-        image_pred[:, 6:] *= image_pred[:, 5:6]
         # Get predicted classes and the confidence score according to it
         class_confs, class_preds = image_pred[:, 6:].max(1, keepdim=True)  # class_preds-> index of classes
-        # Detections matrix nx7 (xywhθ, conf, cls), θ ∈ (-pi/2, pi/2]
-        dets = torch.cat((image_pred[:, :5], class_confs.float(), class_preds.float()), 1)
+        # Object confidence times class confidence (objectness is non-negative, so the argmax is unchanged)
+        class_confs = class_confs * image_pred[:, 5:6]
         # Filter out confidence scores below threshold
-        dets = dets[class_confs.view(-1) > conf_thres]
+        i = class_confs.view(-1) > conf_thres
+        # Detections matrix nx7 (xywhθ, conf, cls), θ ∈ (-pi/2, pi/2]
+        dets = torch.cat((image_pred[i, :5], class_confs[i].float(), class_preds[i].float()), 1)
         # If none are remaining => process next image
         if not dets.shape[0]:
             continue
-        # Sort by it
-        dets = dets[dets[:, 5].argsort(descending=True)]
-        if dets.shape[0] > max_nms:
-            dets = dets[:max_nms]
+        # Keep the max_nms most confident boxes, sorted by score
+        dets = dets[dets[:, 5].topk(min(max_nms, dets.shape[0]))[1]]
 
         # non-maximum suppression
         c = dets[:, -1:] * max_wh  # classes
@@ -1,4 +1,5 @@
 import os
+import contextlib
 import torch
 
 from datasets.custom_dataset import CustomDataset
@@ -6,7 +7,8 @@ from datasets.UCASAOD_dataset import UCASAODDataset
 from datasets.DOTA_dataset import DOTADataset
 
 
-def load_data(data_dir, class_names, dataset_type, hyp, csl, img_size=608, batch_size=4, augment=False, shuffle=True):
+def load_data(data_dir, class_names, dataset_type, hyp, csl, img_size=608, batch_size=4, augment=False, shuffle=True,
+              num_workers=8, persistent_workers=False, prefetch_factor=2, distributed=False):
     if dataset_type == "UCAS_AOD":
         dataset = UCASAODDataset(data_dir, class_names, hyp, img_size=img_size, augment=augment, csl=csl)
     elif dataset_type == "DOTA":
@@ -16,6 +18,67 @@ def load_data(data_dir, class_names, dataset_type, hyp, csl, img_size=608, batch
     else:
         raise NotImplementedError
 
-    dataloader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, num_workers=8, pin_memory=True, collate_fn=dataset.collate_fn)
+    # worker options are only accepted by DataLoader when worker processes are used
+    worker_kwargs = {}
+    if num_workers > 0:
+        worker_kwargs = dict(persistent_workers=persistent_workers, prefetch_factor=prefetch_factor)
+
+    # each process of distributed training reads its own shard of the dataset
+    sampler = torch.utils.data.distributed.DistributedSampler(dataset, shuffle=shuffle) if distributed else None
+
+    dataloader = torch.utils.data.DataLoader(
+        dataset, batch_size=batch_size, shuffle=shuffle and sampler is None, sampler=sampler, num_workers=num_workers,
+        pin_memory=True, collate_fn=dataset.collate_fn, **worker_kwargs
+    )
 
     return dataset, dataloader
+
+
+class DataPrefetcher:
+    """Wrap a dataloader and copy the next batch to the device on a side CUDA stream
+    while the current batch is being processed.
+    Yields (paths, imgs, targets) like the wrapped dataloader, with imgs and targets already on the device.
+    """
+    def __init__(self, dataloader, device, memory_format=torch.contiguous_format):
+        self.dataloader = dataloader
+        self.device = device
+        self.memory_format = memory_format
+        self.stream = torch.cuda.Stream(device) if device.type == 'cuda' else None
+        self.loader = None
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    def start(self):
+        """Create the dataloader iterator ahead of time so that the workers start loading batches
+        before the first call to __iter__.
+        """
+        if self.loader is None:
+            self.loader = iter(self.dataloader)
+
+    def __iter__(self):
+        self.start()
+        loader, self.loader = self.loader, None
+        batch = self.preload(loader)
+        while batch is not None:
+            if self.stream is not None:
+                current_stream = torch.cuda.current_stream(self.device)
+                current_stream.wait_stream(self.stream)
+                # tell the caching allocator that these tensors are used on the compute stream
+                batch[1].record_stream(current_stream)
+                batch[2].record_stream(current_stream)
+            next_batch = self.preload(loader)
+            yield batch
+            batch = next_batch
+
+    def preload(self, loader):
+        try:
+            paths, imgs, targets = next(loader)
+        except StopIteration:
+            return None
+
+        with torch.cuda.stream(self.stream) if self.stream is not None else contextlib.nullcontext():
+            imgs = imgs.to(self.device, non_blocking=True, memory_format=self.memory_format)
+            targets = targets.to(self.device, non_blocking=True)
+
+        return paths, imgs, targets
@@ -1,3 +1,5 @@
+import math
+import warnings
 import numpy as np
 import torch
 import torch.nn as nn
@@ -7,23 +9,35 @@ from detectron2.layers.rotated_boxes import pairwise_iou_rotated
 from lib.general import xywhr2xywhrsigma, norm_angle
 
 
+def jit_script(fn):
+    # torch.jit.script is deprecated in recent PyTorch releases and warns on every import,
+    # it still runs the elementwise helpers below without per-op python overhead and fuses them on GPU
+    with warnings.catch_warnings():
+        warnings.filterwarnings('ignore', message='`torch.jit.script` is deprecated', category=FutureWarning)
+        return torch.jit.script(fn)
+
+
+@jit_script
+def focal_factor(pred, true, gamma: float, alpha: float):
+    # alpha balancing and modulating factor of focal loss, computed from logits
+    pred_prob = torch.sigmoid(pred)  # prob from logits
+    p_t = true * pred_prob + (1 - true) * (1 - pred_prob)
+    alpha_factor = true * alpha + (1 - true) * (1 - alpha)
+    modulating_factor = (1.0 - p_t) ** gamma
+    return alpha_factor * modulating_factor
+
+
 class FocalLoss(nn.Module):
     def __init__(self, loss_fcn, gamma=2, alpha=0.25):
         super(FocalLoss, self).__init__()
         self.loss_fcn = loss_fcn
-        self.gamma = gamma
-        self.alpha = alpha
+        self.gamma = float(gamma)
+        self.alpha = float(alpha)
         self.reduction = loss_fcn.reduction
         self.loss_fcn.reduction = 'none'  # required to apply FL to each element
 
     def forward(self, pred, true):
-        loss = self.loss_fcn(pred, true)
-
-        pred_prob = torch.sigmoid(pred)  # prob from logits
-        p_t = true * pred_prob + (1 - true) * (1 - pred_prob)
-        alpha_factor = true * self.alpha + (1 - true) * (1 - self.alpha)
-        modulating_factor = (1.0 - p_t) ** self.gamma
-        loss *= alpha_factor * modulating_factor
+        loss = self.loss_fcn(pred, true) * focal_factor(pred, true, self.gamma, self.alpha)
 
         if self.reduction == 'mean':
             return loss.mean()
@@ -33,6 +47,7 @@ class FocalLoss(nn.Module):
             return loss
 
 
+@jit_script
 def bbox_ciou(pred_boxes, target_boxes):
     # Reference: https://github.com/Zzh-tju/DIoU-SSD-pytorch/blob/86a370aa2cadea6ba7e5dffb2efc4bacc4c863ea/
     #            utils/box/box_utils.py#L47
@@ -48,24 +63,23 @@ def bbox_ciou(pred_boxes, target_boxes):
 
     # xywh -> xyxy
     # xy is center point, so to get the former x of the bbox, you need to minus the 0.5 * width or height
-    pb = torch.stack([x1 - w1 / 2, y1 - h1 / 2, x1 + w1 / 2, y1 + h1 / 2], dim=-1)
-    tb = torch.stack([x2 - w2 / 2, y2 - h2 / 2, x2 + w2 / 2, y2 + h2 / 2], dim=-1)
-
-    inter_max_xy = torch.min(pb[:, 2:], tb[:, 2:])
-    inter_min_xy = torch.max(pb[:, :2], tb[:, :2])
-    out_max_xy = torch.max(pb[:, 2:], tb[:, 2:])
-    out_min_xy = torch.min(pb[:, :2], tb[:, :2])
-
-    inter = torch.clamp((inter_max_xy - inter_min_xy), min=0)
-    inter_area = inter[:, 0] * inter[:, 1]
-    inter_diag = (x2 - x1) ** 2 + (y2 - y1) ** 2
-    outer = torch.clamp((out_max_xy - out_min_xy), min=0)
-    outer_diag = (outer[:, 0] ** 2) + (outer[:, 1] ** 2) # c ^ 2
+    px1, py1, px2, py2 = x1 - w1 / 2, y1 - h1 / 2, x1 + w1 / 2, y1 + h1 / 2
+    tx1, ty1, tx2, ty2 = x2 - w2 / 2, y2 - h2 / 2, x2 + w2 / 2, y2 + h2 / 2
+
+    inter_w = torch.clamp(torch.min(px2, tx2) - torch.max(px1, tx1), min=0)
+    inter_h = torch.clamp(torch.min(py2, ty2) - torch.max(py1, ty1), min=0)
+    outer_w = torch.clamp(torch.max(px2, tx2) - torch.min(px1, tx1), min=0)
+    outer_h = torch.clamp(torch.max(py2, ty2) - torch.min(py1, ty1), min=0)
+
+    inter_area = inter_w * inter_h
+    inter_diag = (x2 - x1) * (x2 - x1) + (y2 - y1) * (y2 - y1)
+    outer_diag = outer_w * outer_w + outer_h * outer_h # c ^ 2
     union = w1 * h1 + w2 * h2 - inter_area
     u = inter_diag / (outer_diag + 1e-15)
 
     iou = inter_area / (union + 1e-15)
-    v = (4 / (np.pi ** 2)) * torch.pow((torch.atan(w2 / h2) - torch.atan(w1 / h1)), 2)
+    da = torch.atan(w2 / h2) - torch.atan(w1 / h1)
+    v = (4 / (math.pi ** 2)) * da * da
 
     # alpha is a constant, it don't have gradient
     with torch.no_grad():
@@ -78,6 +92,19 @@ def bbox_ciou(pred_boxes, target_boxes):
     return ciou
 
 
+@jit_script
+def kfiou(wh_p, wh_t, dr, alpha: float):
+    # closed form of KFIoU between two oriented boxes from their sizes and angle difference
+    wp2, hp2 = wh_p[:, 0] * wh_p[:, 0], wh_p[:, 1] * wh_p[:, 1]
+    wt2, ht2 = wh_t[:, 0] * wh_t[:, 0], wh_t[:, 1] * wh_t[:, 1]
+    cos2dr, sin2dr = torch.cos(dr) * torch.cos(dr), torch.sin(dr) * torch.sin(dr)
+
+    A = torch.sqrt(1 + (wp2 * hp2) / (wt2 * ht2) + (wp2 / wt2 + hp2 / ht2) * cos2dr + (wp2 / ht2 + hp2 / wt2) * sin2dr)
+    B = torch.sqrt(1 + (wt2 * ht2) / (wp2 * hp2) + (wt2 / wp2 + ht2 / hp2) * cos2dr + (wt2 / hp2 + ht2 / wp2) * sin2dr)
+
+    return (4 - alpha) / (A + B - alpha)
+
+
 class KFLoss(nn.Module):
     """Kalman filter based loss.
     ref: https://github.com/open-mmlab/mmrotate/blob/main/mmrotate/models/losses/kf_iou_loss.py
@@ -129,14 +156,7 @@ class KFLoss(nn.Module):
 
         #KFIoU = (4 - self.alpha) * Vb / (Vb_p + Vb_t - self.alpha * Vb + 1e-6)
 
-        wp2, hp2 = wh_p[:, 0] ** 2, wh_p[:, 1] ** 2
-        wt2, ht2 = wh_t[:, 0] ** 2, wh_t[:, 1] ** 2
-        cos2dr, sin2dr = torch.cos(r_p - r_t) ** 2, torch.sin(r_p - r_t) ** 2
-
-        A = torch.sqrt(1 + (wp2 * hp2) / (wt2 * ht2) + (wp2 / wt2 + hp2 / ht2) * cos2dr + (wp2 / ht2 + hp2 / wt2) * sin2dr)
-        B = torch.sqrt(1 + (wt2 * ht2) / (wp2 * hp2) + (wt2 / wp2 + ht2 / hp2) * cos2dr + (wt2 / hp2 + ht2 / wp2) * sin2dr)
-
-        KFIoU = (4 - self.alpha) / (A + B - self.alpha)
+        KFIoU = kfiou(wh_p, wh_t, r_p - r_t, self.alpha)
 
         if self.fun == 'ln':
             kf_loss = -torch.log(KFIoU + 1e-6)
@@ -179,6 +199,13 @@ class ComputeCSLLoss:
         self.nl = 3
         self.nc = model.nc # number of classes
 
+        # constant tensors of build_targets(), allocated once instead of every call
+        self.gain = torch.ones(188, device=device).long()
+        self.off = torch.tensor([[0, 0],
+                                 [1, 0], [0, 1], [-1, 0], [0, -1],  # j,k,l,m
+                                 # [1, 1], [1, -1], [-1, 1], [-1, -1],  # jk,jm,lk,lm
+                                 ], device=device).float() * 0.5
+
         # Logging Info
         self.loss_items = {
             "reg_loss": 0,
@@ -222,8 +249,7 @@ class ComputeCSLLoss:
 
                     if self.nc > 1:
                         pcls = ps[..., 5:5 + self.nc] # confidence score of classses
-                        t = torch.zeros_like(pcls, device=device)  # targets
-                        t[range(b.shape[0]), tcls[i]] = 1
+                        t = torch.zeros_like(pcls, device=device).scatter_(1, tcls[i][:, None], 1.0)  # targets
                         # Binary Cross Entropy Loss for class' prediction
                         cls_loss += self.BCEcls(pcls, t)
 
@@ -258,11 +284,11 @@ class ComputeCSLLoss:
         # -   Logging Info   -
         # --------------------
         self.loss_items.update({
-            "reg_loss": reg_loss.detach().cpu().item(),
-            'theta_loss': theta_loss.detach().cpu().item(),
-            "conf_loss": conf_loss.detach().cpu().item(),
-            "cls_loss": cls_loss.detach().cpu().item(),
-            "total_loss": loss.detach().cpu().item()
+            "reg_loss": reg_loss.detach(),
+            'theta_loss': theta_loss.detach(),
+            "conf_loss": conf_loss.detach(),
+            "cls_loss": cls_loss.detach(),
+            "total_loss": loss.detach()
         })
 
         return loss, self.loss_items
@@ -271,17 +297,14 @@ class ComputeCSLLoss:
         # Build targets for compute_loss(), input targets(image,class,x,y,w,h)
         na, nt = self.na, targets.shape[0]  # number of anchors, targets
         tcls, tbox, ta, tg, indices, anch = [], [], [], [], [], []
-        gain = torch.ones(188, device=targets.device).long()  # normalized to gridspace gain
+        gain = self.gain  # normalized to gridspace gain
         ai = torch.arange(na, device=targets.device).float().view(na, 1).repeat(1, nt)  # same as .repeat_interleave(nt)
 
         # targets-> (na, nt, 187 + 1)
         targets = torch.cat((targets.repeat(na, 1, 1), ai[:, :, None]), 2)  # append anchor indices
 
         g = 0.5  # bias
-        off = torch.tensor([[0, 0],
-                            [1, 0], [0, 1], [-1, 0], [0, -1],  # j,k,l,m
-                            # [1, 1], [1, -1], [-1, 1], [-1, -1],  # jk,jm,lk,lm
-                            ], device=targets.device).float() * g  # offsets
+        off = self.off  # offsets
 
         for i in range(self.nl):
             anchors = self.anchors[i]
@@ -357,6 +380,13 @@ class ComputeKFIoULoss:
         self.nl = 3
         self.nc = model.nc # number of classes
 
+        # constant tensors of build_targets(), allocated once instead of every call
+        self.gain = torch.ones(8, device=device).long()
+        self.off = torch.tensor([[0, 0],
+                                 [1, 0], [0, 1], [-1, 0], [0, -1],  # j,k,l,m
+                                 # [1, 1], [1, -1], [-1, 1], [-1, -1],  # jk,jm,lk,lm
+                                 ], device=device).float() * 0.5
+
         # Logging Info
         self.loss_items = {
             "reg_loss": 0,
@@ -398,8 +428,7 @@ class ComputeKFIoULoss:
 
                     if self.nc > 1:
                         pcls = ps[..., 6:] # class confidence scores
-                        t = torch.zeros_like(pcls, device=device)  # targets
-                        t[range(b.shape[0]), tcls[i]] = 1
+                        t = torch.zeros_like(pcls, device=device).scatter_(1, tcls[i][:, None], 1.0)  # targets
                         # Binary Cross Entropy Loss for class' prediction
                         cls_loss += self.BCEcls(pcls, t)
 
@@ -416,10 +445,10 @@ class ComputeKFIoULoss:
         # -   Logging Info   -
         # --------------------
         self.loss_items.update({
-            "reg_loss": reg_loss.detach().cpu().item(),
-            "conf_loss": conf_loss.detach().cpu().item(),
-            "cls_loss": cls_loss.detach().cpu().item(),
-            "total_loss": loss.detach().cpu().item()
+            "reg_loss": reg_loss.detach(),
+            "conf_loss": conf_loss.detach(),
+            "cls_loss": cls_loss.detach(),
+            "total_loss": loss.detach()
         })
 
         return loss, self.loss_items
@@ -428,17 +457,14 @@ class ComputeKFIoULoss:
         # Build targets for compute_loss(), input targets(image,class,x,y,w,h)
         na, nt = self.na, targets.shape[0]  # number of anchors, targets
         tcls, tbox, indices, anch = [], [], [], []
-        gain = torch.ones(8, device=targets.device).long()  # normalized to gridspace gain
+        gain = self.gain  # normalized to gridspace gain
         ai = torch.arange(na, device=targets.device).float().view(na, 1).repeat(1, nt)  # same as .repeat_interleave(nt)
 
         # targets-> (na, nt, 7 + 1)
         targets = torch.cat((targets.repeat(na, 1, 1), ai[:, :, None]), 2)  # append anchor indices
 
         g = 0.5  # bias
-        off = torch.tensor([[0, 0],
-                            [1, 0], [0, 1], [-1, 0], [0, -1],  # j,k,l,m
-                            # [1, 1], [1, -1], [-1, 1], [-1, -1],  # jk,jm,lk,lm
-                            ], device=targets.device).float() * g  # offsets
+        off = self.off  # offsets
 
         for i in range(self.nl):
             anchors = self.anchors[i]
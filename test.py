@@ -119,7 +119,6 @@ def get_batch_statistics(outputs, targets, iouv, niou):
         true_positives = torch.zeros(pred.shape[0], niou, dtype=torch.bool, device=targets.device)
         
         if nl:
-            detected_boxes = []
             target_labels = tar[:, 0]
             target_boxes = tar[:, 1:6]
 
@@ -127,22 +126,19 @@ def get_batch_statistics(outputs, targets, iouv, niou):
             pred_boxes[:, 4] = pred_boxes[:, 4] / np.pi * 180
             target_boxes[:, 4] = target_boxes[:, 4] / np.pi * 180
 
-            for cls in torch.unique(target_labels):
-                ti = (cls == target_labels).nonzero(as_tuple=False).view(-1)  # target indices
-                pi = (cls == pred_labels).nonzero(as_tuple=False).view(-1)  # prediction indices
+            # match all classes at once, predictions never match targets of another class
+            ious = pairwise_iou_rotated(pred_boxes, target_boxes)
+            ious[pred_labels[:, None] != target_labels[None, :]] = 0
+            ious, i = ious.max(1)
 
-                if pi.shape[0]:
-                    ious, i = pairwise_iou_rotated(pred_boxes[pi], target_boxes[ti]).max(1)
-
-                    detected_set = set()
-                    for j in (ious > iouv[0]).nonzero(as_tuple=False):
-                        d = ti[i[j]] # detected target
-                        if d.item() not in detected_set:
-                            detected_set.add(d.item())
-                            detected_boxes.append(d)
-                            true_positives[pi[j]] = ious[j] > iouv
-                            if len(detected_boxes) == nl: # all targets already located in image
-                                break
+            detected_set = set()
+            for j in (ious > iouv[0]).nonzero(as_tuple=False):
+                d = i[j].item() # detected target
+                if d not in detected_set:
+                    detected_set.add(d)
+                    true_positives[j] = ious[j] > iouv
+                    if len(detected_set) == nl: # all targets already located in image
+                        break
 
         # Append statistics (tp, conf, pcls, tcls)
         batch_stats.append((true_positives.cpu(), pred_scores.cpu(), pred_labels.cpu(), tcls))
@@ -164,12 +160,13 @@ def calculate_eval_stats(stats, num_classes):
     return nt, p, r, ap50, ap, f1, ap_class, mp, mr, map50, map
 
 
-def test(model, compute_loss, device, data, hyp, csl_labels, img_size, batch_size, conf_thres, iou_thres):
+def test(model, compute_loss, device, data, hyp, csl_labels, img_size, batch_size, conf_thres, iou_thres, num_workers=8):
     model.eval()
 
     # Get dataloader
     test_dataset, test_dataloader = load_data(
-        data['val'], data['names'], data['type'], hyp, csl_labels, img_size, batch_size, shuffle=False
+        data['val'], data['names'], data['type'], hyp, csl_labels, img_size, batch_size, shuffle=False,
+        num_workers=num_workers
     )
 
     logger.info("Compute mAP...")
@@ -178,11 +175,11 @@ def test(model, compute_loss, device, data, hyp, csl_labels, img_size, batch_siz
     iouv = torch.linspace(0.5, 0.95, 10).to(device) # iou vector for mAP@0.5:0.95
     niou = iouv.numel()
     seen = 0
-    total_loss_items = {}
+    total_loss_items = {name: torch.zeros(1, device=device) for name in compute_loss.loss_items}
 
     for i, (_, imgs, targets) in enumerate(tqdm.tqdm(test_dataloader)):
-        imgs = imgs.to(device)
-        targets = targets.to(device)
+        imgs = imgs.to(device, non_blocking=True)
+        targets = targets.to(device, non_blocking=True)
         seen += len(imgs)
 
         with torch.no_grad():
@@ -191,10 +188,7 @@ def test(model, compute_loss, device, data, hyp, csl_labels, img_size, batch_siz
             infer_outputs = post_process(infer_outputs, conf_thres=conf_thres, iou_thres=iou_thres)
 
             for item in loss_items:
-                if item in total_loss_items:
-                    total_loss_items[item] += loss_items[item]
-                else:
-                    total_loss_items[item] = loss_items[item]
+                total_loss_items[item] += loss_items[item]
 
         # Rescale target
         targets[:, 2:6] *= img_size
@@ -217,7 +211,7 @@ def test(model, compute_loss, device, data, hyp, csl_labels, img_size, batch_siz
 
     # average losses
     for item in total_loss_items:
-        total_loss_items[item] /= len(test_dataloader)
+        total_loss_items[item] = total_loss_items[item].item() / len(test_dataloader)
 
     return mp, mr, map50, map, total_loss_items
 
@@ -258,7 +252,7 @@ class Test:
             compute_loss = ComputeKFIoULoss(self.model, hyp_cfg)
 
         test(self.model, compute_loss, self.device, data, hyp_cfg, csl,
-                self.args.img_size, self.args.batch_size, self.args.conf_thres, self.args.iou_thres)
+                self.args.img_size, self.args.batch_size, self.args.conf_thres, self.args.iou_thres, self.args.workers)
 
 
 if __name__ == "__main__":
@@ -272,6 +266,7 @@ if __name__ == "__main__":
     parser.add_argument("--img_size", type=int, default=608, help="size of each image dimension")
     parser.add_argument("--data", type=str, default="", help=".yaml path for data")
     parser.add_argument("--hyp", type=str, default="", help=".yaml path for hyperparameters")
+    parser.add_argument("--workers", type=int, default=8, help="number of dataloader worker processes")
 
     args = parser.parse_args()
     print(args)
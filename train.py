@@ -1,3 +1,5 @@
+import contextlib
+import functools
 import math
 import random
 import os
@@ -6,23 +8,33 @@ import json
 import tqdm
 import yaml
 import argparse
+import concurrent.futures
+import datetime
 import numpy as np
 import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel as DDP
 from torch.optim.lr_scheduler import LambdaLR
 
 from model.yolo import Yolo
-from lib.load import load_data
+from lib.load import load_data, DataPrefetcher
 from lib.logger import Logger, logger
 from lib.loss import ComputeCSLLoss, ComputeKFIoULoss
 from test import test
 
 
-def init():
-    random.seed(42)
-    np.random.seed(42)
-    torch.manual_seed(42)
-    torch.backends.cudnn.deterministic = True
-    torch.backends.cudnn.benchmark = False
+def init_seed(seed=42):
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+
+def init(deterministic=False, seed=42):
+    init_seed(seed)
+    # input size is fixed, so let cuDNN benchmark and cache the fastest conv algorithms unless reproducibility is required
+    torch.backends.cudnn.deterministic = deterministic
+    torch.backends.cudnn.benchmark = not deterministic
+    torch.backends.cuda.matmul.allow_tf32 = not deterministic
 
 
 def weights_init_normal(m):
@@ -39,18 +51,36 @@ def one_cycle(y1=0.0, y2=1.0, steps=100):
 
 
 def fitness(x):
-    # Model fitness as a weighted combination of metrics
-    w = [0.0, 0.0, 0.1, 0.9]  # weights for [P, R, mAP@0.5, mAP@0.5:0.95]
-    return (x * w).sum(0)
+    # Model fitness as a weighted combination of metrics [P, R, mAP@0.5, mAP@0.5:0.95], weights are [0.0, 0.0, 0.1, 0.9]
+    _, _, map50, map5095 = x
+    return 0.1 * map50 + 0.9 * map5095
 
 
 class Train:
     def __init__(self, args):
         self.args = args
-        self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        self.local_rank = args.local_rank
+        if self.local_rank != -1:
+            # one process per GPU, launched by torchrun
+            torch.cuda.set_device(self.local_rank)
+            # rank 0 validates alone while the other processes wait, so allow collectives to wait much longer than the default
+            dist.init_process_group(backend='nccl', timeout=datetime.timedelta(hours=3))
+            self.device = torch.device('cuda', self.local_rank)
+        else:
+            self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        self.rank = dist.get_rank() if self.local_rank != -1 else 0
+        self.world_size = dist.get_world_size() if self.local_rank != -1 else 1
+        if self.args.batch_size % self.world_size != 0:
+            raise ValueError(
+                "--batch_size ({}) must be a multiple of the number of GPUs ({}).".format(self.args.batch_size, self.world_size)
+            )
         self.model_path = os.path.join("weights", self.args.model_name)
         self.model = None
         self.logger = None
+        self.scaler = torch.amp.GradScaler('cuda', enabled=self.device.type == 'cuda')
+        # checkpoints are written to disk in the background, one at a time
+        self.ckpt_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.ckpt_futures = []
 
     def check_model_path(self):
         if os.path.exists(self.model_path):
@@ -62,32 +92,69 @@ class Train:
                     break
                 elif inp.lower()[0] == "n":
                     logger.info("Stop training!")
-                    exit(0)
+                    return False
                     
         os.makedirs(self.model_path)
         os.makedirs(os.path.join(self.model_path, "logs"))
+        return True
 
     def load_model(self, n_classes, model_config, mode, ver):
         self.model = Yolo(n_classes, model_config, mode, ver)
         self.model = self.model.to(self.device)
-        self.model.apply(weights_init_normal)  # 權重初始化
+        if self.args.channels_last:
+            self.model = self.model.to(memory_format=torch.channels_last)
 
+        pretrained_dict = {}
         if len(self.args.weights_path):
-            logger.info("Loading pretrained weights from: {}".format(self.args.weights_path))
+            if self.rank == 0:
+                logger.info("Loading pretrained weights from: {}".format(self.args.weights_path))
             # 1. filter out unnecessary keys
             # 第552項開始為yololayer，訓練時不需要用到
             # pretrained_dict = {k: v for k, v in pretrained_dict.items() if np.shape(model_dict[k]) == np.shape(v)}
-            pretrained_dict = torch.load(self.args.weights_path)
+            pretrained_dict = torch.load(self.args.weights_path, map_location=self.device)
             pretrained_dict = {k: v for i, (k, v) in enumerate(pretrained_dict.items()) if i < 552}
+
+        # 權重初始化, layers overwritten by the pretrained weights are skipped
+        for name, m in self.model.named_modules():
+            if "{}.weight".format(name) not in pretrained_dict:
+                weights_init_normal(m)
+
+        if len(pretrained_dict):
             # 2. overwrite entries in the existing state dict
             model_dict = self.model.state_dict()
             model_dict.update(pretrained_dict)
             # 3. load the new state dict
             self.model.load_state_dict(model_dict)
 
+    def de_compile(self):
+        # return the model without the torch.compile wrapper
+        return getattr(self.model, "_orig_mod", self.model)
+
+    def de_parallel(self):
+        # return the bare model when it is wrapped by torch.compile and/or DistributedDataParallel
+        model = self.de_compile()
+        return model.module if isinstance(model, DDP) else model
+
     def save_model(self, weightname):
         save_folder = os.path.join(self.model_path, "{}.pth".format(weightname))
-        torch.save(self.model.state_dict(), save_folder)
+        # take a copy on the CPU so that training can continue while the checkpoint is being written
+        state_dict = {k: v.detach().to("cpu", copy=True) for k, v in self.de_parallel().state_dict().items()}
+        # wait for the previous writes, which also raises any error from them
+        self.wait_ckpt()
+        self.ckpt_futures.append(self.ckpt_pool.submit(torch.save, state_dict, save_folder))
+
+    def copy_model(self, src_weightname, dst_weightname):
+        # the single worker runs jobs in order, so the source checkpoint is complete when it is copied
+        self.ckpt_futures.append(self.ckpt_pool.submit(
+            shutil.copyfile,
+            os.path.join(self.model_path, "{}.pth".format(src_weightname)),
+            os.path.join(self.model_path, "{}.pth".format(dst_weightname))
+        ))
+
+    def wait_ckpt(self):
+        for future in self.ckpt_futures:
+            future.result()
+        self.ckpt_futures = []
 
     def save_opts(self, config):
         """Save options to disk so we know what we ran this experiment with
@@ -108,17 +175,19 @@ class Train:
         for name, loss in total_val_loss.items():
             tensorboard_log[f"val/{name}"] = loss
 
-        # log metrics
-        tensorboard_log["metrics/mean recall"] = mr
-        tensorboard_log["metrics/mean precision"] = mp
-        tensorboard_log["metrics/mAP@.5"] = map50
-        tensorboard_log["metrics/mAP@.5:.95"] = map5095
+        # log metrics, they are None on epochs without validation
+        if map5095 is not None:
+            tensorboard_log["metrics/mean recall"] = mr
+            tensorboard_log["metrics/mean precision"] = mp
+            tensorboard_log["metrics/mAP@.5"] = map50
+            tensorboard_log["metrics/mAP@.5:.95"] = map5095
         tensorboard_log["lr"] = lr
 
         self.logger.list_of_scalars_summary(tensorboard_log, epoch)
 
     def train(self):
-        init()
+        # offset the seed by the rank, so that the dataloader workers of each process draw different augmentations
+        init(self.args.deterministic, 42 + self.rank)
 
         # load data info
         with open(self.args.data, "r") as stream:
@@ -129,29 +198,66 @@ class Train:
             config = yaml.safe_load(stream)
 
         model_cfg, hyp_cfg = config['model'], config['hyp']
+        csl = self.args.mode == "csl"
+
+        # --batch_size is the total batch size, split evenly over the processes
+        train_dataset, train_dataloader = load_data(
+            data['train'], data['names'], data['type'], hyp_cfg, csl, self.args.img_size, self.args.batch_size // self.world_size,
+            augment=True, num_workers=self.args.workers, persistent_workers=True, prefetch_factor=4,
+            distributed=self.local_rank != -1
+        )
+        num_iters_per_epoch = len(train_dataloader)
 
-        self.check_model_path()
+        # start the dataloader workers now, so the first batches are loaded while the model is being set up
+        if self.local_rank != -1:
+            train_dataloader.sampler.set_epoch(0)
+        memory_format = torch.channels_last if self.args.channels_last else torch.contiguous_format
+        prefetcher = DataPrefetcher(train_dataloader, self.device, memory_format)
+        prefetcher.start()
+
+        # only the first process asks whether to override the model path, the others follow its answer
+        proceed = [self.check_model_path() if self.rank == 0 else None]
+        if self.local_rank != -1:
+            dist.broadcast_object_list(proceed, src=0)
+        if not proceed[0]:
+            if self.local_rank != -1:
+                dist.destroy_process_group()
+            exit(0)
         self.load_model(len(data["names"]), model_cfg, self.args.mode, self.args.ver)
-        self.save_opts(config)
-        self.logger = Logger(os.path.join(self.model_path, "logs"))
+        if self.rank == 0:
+            self.save_opts(config)
+            self.logger = Logger(os.path.join(self.model_path, "logs"))
 
-        if self.args.mode == "csl":
-            csl = True
+        if csl:
             compute_loss = ComputeCSLLoss(self.model, hyp_cfg)
         else:
-            csl = False
             compute_loss = ComputeKFIoULoss(self.model, hyp_cfg)
 
-        train_dataset, train_dataloader = load_data(
-            data['train'], data['names'], data['type'], hyp_cfg, csl, self.args.img_size, self.args.batch_size, augment=True
-        )
-        num_iters_per_epoch = len(train_dataloader)
+        if self.local_rank != -1:
+            self.model = DDP(self.model, device_ids=[self.local_rank], output_device=self.local_rank, gradient_as_bucket_view=True)
+
+        if self.args.compile:
+            if hasattr(torch, "compile"):
+                # compile after DDP wrapping, so the graph is split at the gradient buckets and all-reduce overlaps with backward
+                # kernels are generated on the first training step
+                self.model = torch.compile(self.model, mode="max-autotune", dynamic=False)
+            elif self.rank == 0:
+                logger.warning("torch.compile is not available in this version of PyTorch, --compile is ignored.")
+        ddp_model = self.de_compile()
+        ddp_model = ddp_model if isinstance(ddp_model, DDP) else None
 
         nbs = 64  # nominal batch size
         accumulate = max(round(nbs / self.args.batch_size), 1)  # accumulate loss before optimizing
 
         if self.args.optimizer == "Adam":
-            optimizer = torch.optim.Adam(self.model.parameters(), lr=self.args.lr)
+            # update all parameters in fused kernels on GPU, NVIDIA Apex is used if it is installed
+            Adam = functools.partial(torch.optim.Adam, fused=self.device.type == 'cuda')
+            if self.device.type == 'cuda':
+                try:
+                    from apex.optimizers import FusedAdam as Adam
+                except ImportError:
+                    pass
+            optimizer = Adam(self.model.parameters(), lr=self.args.lr)
         elif self.args.optimizer == "SGD":
             optimizer = torch.optim.SGD(self.model.parameters(), lr=self.args.lr, momentum=0.937, nesterov=True)
         else:
@@ -162,8 +268,14 @@ class Train:
         scheduler = LambdaLR(optimizer, lr_lambda=lf)
         initial_lr = optimizer.param_groups[0]['initial_lr']
 
-        logger.info(f'Image sizes {self.args.img_size}')
-        logger.info(f'Starting training for {self.args.epochs} epochs...')
+        # warmup lookup tables indexed by global step, the lr ramps linearly from 0 to initial_lr * lf(epoch)
+        warmup_steps = np.arange(nw + 1)
+        warmup_accumulate = np.maximum(1, np.interp(warmup_steps, [0, nw], [1, nbs / self.args.batch_size]).round()).astype(int).tolist()
+        warmup_lr_scale = np.interp(warmup_steps, [0, nw], [0.0, 1.0]).tolist()
+
+        if self.rank == 0:
+            logger.info(f'Image sizes {self.args.img_size}')
+            logger.info(f'Starting training for {self.args.epochs} epochs...')
         
         best_fitness = -1
 
@@ -172,76 +284,105 @@ class Train:
             # ------ Train ------
             # -------------------
             self.model.train()
-            total_train_loss = {}
+            # running sums stay on the device, they are only read back at the end of the epoch
+            total_train_loss = {name: torch.zeros(1, device=self.device) for name in compute_loss.loss_items}
+            if self.local_rank != -1:
+                train_dataloader.sampler.set_epoch(epoch)
       
             s = ('\n' + '%10s' * 2) % ('Epoch', 'lr')
             for name in compute_loss.loss_items.keys():
                 s += ('%12s') % name
-            logger.info(s)
+            if self.rank == 0:
+                logger.info(s)
 
-            pbar = enumerate(train_dataloader)
-            pbar = tqdm.tqdm(pbar, total=len(train_dataloader))
+            pbar = enumerate(prefetcher)
+            pbar = tqdm.tqdm(pbar, total=len(train_dataloader), disable=self.rank != 0)
             for batch, (_, imgs, targets) in pbar:
                 global_step = num_iters_per_epoch * epoch + batch + 1
-                imgs = imgs.to(self.device)
-                targets = targets.to(self.device)
 
                 # warmup
                 if global_step <= nw:
-                    xi = [0, nw]  # x interp
-                    accumulate = max(1, np.interp(global_step, xi, [1, nbs / self.args.batch_size]).round())
-                    optimizer.param_groups[0]['lr'] = np.interp(global_step, xi, [0.0, initial_lr * lf(epoch)])
+                    accumulate = warmup_accumulate[global_step]
+                    optimizer.param_groups[0]['lr'] = warmup_lr_scale[global_step] * initial_lr * lf(epoch)
 
-                outputs = self.model(imgs, training=True)
-                loss, loss_items = compute_loss(outputs, targets)
+                # only all-reduce gradients on the step that updates the weights
+                if ddp_model is not None and global_step % accumulate != 0:
+                    sync_context = ddp_model.no_sync()
+                else:
+                    sync_context = contextlib.nullcontext()
 
-                loss.backward()
+                with sync_context:
+                    with torch.autocast(self.device.type, enabled=self.scaler.is_enabled()):
+                        outputs = self.model(imgs, training=True)
+                    # loss is computed in fp32, KFLoss inverts covariance matrices which is not supported in half precision
+                    loss, loss_items = compute_loss([output.float() for output in outputs], targets)
+
+                    self.scaler.scale(loss).backward()
 
                 if global_step % accumulate == 0:
-                    optimizer.step()
-                    optimizer.zero_grad()
+                    self.scaler.step(optimizer)
+                    self.scaler.update()
+                    optimizer.zero_grad(set_to_none=True)
                 
-                # print info
-                s = ('%10s' + '%10.4g') % ('%g/%g' % (epoch + 1, self.args.epochs), optimizer.param_groups[0]["lr"])
-                for loss in loss_items.values():
-                    s += ('%12.4g') % loss
-
                 # store loss items
                 for item in loss_items:
-                    if item in total_train_loss:
-                        total_train_loss[item] += loss_items[item]
-                    else:
-                        total_train_loss[item] = loss_items[item]
+                    total_train_loss[item] += loss_items[item]
 
-                pbar.set_description(s)
-                pbar.update(0)
+                # print info, only every 20 batches since reading the losses back waits for the GPU
+                if global_step % 20 == 0 or batch == num_iters_per_epoch - 1:
+                    s = ('%10s' + '%10.4g') % ('%g/%g' % (epoch + 1, self.args.epochs), optimizer.param_groups[0]["lr"])
+                    for loss in loss_items.values():
+                        s += ('%12.4g') % loss
+                    pbar.set_description(s)
 
             lr = optimizer.param_groups[0]["lr"] # for tensorboard
             scheduler.step()
 
-            # -------------------
-            # ------ Valid ------
-            # -------------------
-            mp, mr, map50, map5095, total_val_loss = test(
-                self.model, compute_loss, self.device, data, hyp_cfg, csl,
-                self.args.img_size, self.args.batch_size * 2, conf_thres=0.001, iou_thres=0.65
-            )
-
-            # average losses
-            for item in total_train_loss:
-                total_train_loss[item] /= len(train_dataloader)
-
-            # update logging info for tensorboard every epoch  
-            self.logging_processes(epoch, total_train_loss, total_val_loss, mr, mp , map50, map5095, lr)
-
-            fit = fitness(np.array([mp, mr, map50, map5095]))
-            if fit > best_fitness:
-                best_fitness = fit
-                self.save_model("best")
-                logger.info("Current best model is saved!")
-            self.save_model("last")
-
-        logger.info("Done!")
+            # validation, logging and checkpoints are handled by the first process only
+            if self.rank == 0:
+                # -------------------
+                # ------ Valid ------
+                # -------------------
+                # validate every val_interval epochs and after the last epoch
+                validate = (epoch + 1) % self.args.val_interval == 0 or epoch == self.args.epochs - 1
+                if validate:
+                    mp, mr, map50, map5095, total_val_loss = test(
+                        self.de_parallel(), compute_loss, self.device, data, hyp_cfg, csl,
+                        self.args.img_size, self.args.batch_size // self.world_size * 2, conf_thres=0.001, iou_thres=0.65, num_workers=self.args.workers
+                    )
+                else:
+                    mp = mr = map50 = map5095 = None
+                    total_val_loss = {}
+
+                # average losses
+                for item in total_train_loss:
+                    total_train_loss[item] = total_train_loss[item].item() / len(train_dataloader)
+
+                # update logging info for tensorboard every epoch  
+                self.logging_processes(epoch, total_train_loss, total_val_loss, mr, mp , map50, map5095, lr)
+
+                self.save_model("last")
+                if validate:
+                    fit = fitness((mp, mr, map50, map5095))
+                    if fit > best_fitness:
+                        best_fitness = fit
+                        # the best model is the one just saved as last, copy the file instead of serializing it again
+                        self.copy_model("last", "best")
+                        logger.info("Current best model is saved!")
+
+            # the other processes wait here, so they do not start the next epoch while the first one is validating
+            if self.local_rank != -1:
+                dist.barrier()
+
+        # wait for the remaining checkpoints to be written
+        self.wait_ckpt()
+        self.ckpt_pool.shutdown()
+
+        if self.local_rank != -1:
+            dist.destroy_process_group()
+
+        if self.rank == 0:
+            logger.info("Done!")
 
         
 if __name__ == "__main__":
@@ -249,7 +390,7 @@ if __name__ == "__main__":
     parser.add_argument("--epochs", type=int, default=80, help="number of epochs")
     parser.add_argument("--optimizer", default="SGD", nargs='?', choices=['Adam', 'SGD'], help="specify a optimizer for training")
     parser.add_argument("--lr", type=float, default=0.01, help="learning rate")
-    parser.add_argument("--batch_size", type=int, default=4, help="size of batches")
+    parser.add_argument("--batch_size", type=int, default=4, help="total size of batches over all GPUs")
     parser.add_argument("--img_size", type=int, default=608, help="size of each image dimension")
     parser.add_argument("--weights_path", type=str, default="", help="path to pretrained weights file")
     parser.add_argument("--model_name", type=str, default="trash", help="new model name")
@@ -257,10 +398,18 @@ if __name__ == "__main__":
     parser.add_argument("--ver", default="yolov5", nargs='?', choices=['yolov4', 'yolov5', 'yolov7'], help="specify a yolo version")
     parser.add_argument("--data", type=str, default="", help=".yaml path for data")
     parser.add_argument("--config", type=str, default="", help=".yaml path for configs")
+    parser.add_argument("--val_interval", type=int, default=1, help="run validation every n epochs")
+    parser.add_argument("--workers", type=int, default=8, help="number of dataloader worker processes")
+    parser.add_argument("--compile", action="store_true", help="compile the model with torch.compile")
+    parser.add_argument("--channels_last", action="store_true", help="use channels_last memory format for the model and inputs")
+    parser.add_argument("--deterministic", action="store_true", help="use deterministic cuDNN algorithms instead of the autotuner")
+    parser.add_argument("--local_rank", type=int, default=int(os.environ.get("LOCAL_RANK", -1)), help="local rank for distributed training, set by torchrun")
 
     args = parser.parse_args()
+    if args.val_interval < 1:
+        parser.error("--val_interval must be at least 1")
     print(args)
 
-    init()
+    init(args.deterministic)
     t = Train(args)
     t.train()